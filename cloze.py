@@ -1,37 +1,75 @@
-import copy
+import collections
+import functools
 import glob
 import os
-import random
 import sys
 
+import numpy as np
 import torch
 from transformers import AutoTokenizer, AutoModelForMaskedLM
 
 
 class BertGeneration(object):
 
-    def __init__(self, model_name, tokenizer):
+    def __init__(self, model_name, tokenizer, full_precision=False, compile=False, onnx=False, int8=False):
 
         # Load pre-trained model (weights)
 
-        self.model = AutoModelForMaskedLM.from_pretrained(model_name)
-        self.model.eval()
         self.cuda = torch.cuda.is_available()
-        if self.cuda:
-            self.model = self.model.cuda()
+        self.eager_model = None  # uncompiled model for the unpadded one sentence fallback, when compiling
+        self.model_errors = (RuntimeError, IndexError)  # what the model raises on ids outside its vocabulary
+        if onnx:
+            self.model = self.load_onnx_model(model_name)
+        else:
+            try:  # fused scaled dot-product attention kernels, flash attention on recent GPUs in half precision
+                self.model = AutoModelForMaskedLM.from_pretrained(model_name, attn_implementation='sdpa')
+            except ValueError:  # the architecture has no SDPA implementation
+                self.model = AutoModelForMaskedLM.from_pretrained(model_name)
+            self.model.eval()
+            if self.cuda:
+                self.model = self.model.cuda()
+                if not full_precision:  # only the ranking of the logits is used, half precision is enough
+                    if torch.cuda.get_device_capability()[0] >= 8:  # native bf16 from Ampere on
+                        self.model = self.model.to(torch.bfloat16)
+                    else:
+                        self.model = self.model.half()
+            elif int8 and not compile:  # int8 linear layers on CPU, dynamo cannot trace them
+                self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+            if compile:
+                # DataMangler pads the batches to a few static shapes, allow one compiled graph per shape
+                torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+                self.eager_model = self.model
+                self.model = torch.compile(self.model, mode='reduce-overhead', fullgraph=True, dynamic=False)
 
         # Load pre-trained model tokenizer (vocabulary)
         if tokenizer:
-            self.tokenizer = AutoTokenizer.from_pretrained(tokenizer)
+            self.tokenizer = AutoTokenizer.from_pretrained(tokenizer, use_fast=True)
         else:
-            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+            self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
 
         self.CLS = '[CLS]'
         self.SEP = '[SEP]'
         self.MASK = '[MASK]'
+        self.PAD = '[PAD]'
         self.mask_id = self.tokenizer.convert_tokens_to_ids([self.MASK])[0]
         self.sep_id = self.tokenizer.convert_tokens_to_ids([self.SEP])[0]
         self.cls_id = self.tokenizer.convert_tokens_to_ids([self.CLS])[0]
+        self.pad_id = self.tokenizer.convert_tokens_to_ids([self.PAD])[0]
+
+        # the batch inputs are copied into a GPU buffer that is reused by every batch
+        self.device_buffer = None
+
+    def load_onnx_model(self, model_name):
+        """ Exports the model to ONNX and wraps it in ONNX Runtime, it is called just like the PyTorch model """
+        try:
+            from optimum.onnxruntime import ORTModelForMaskedLM
+        except ImportError:
+            raise ImportError('ONNX Runtime inference needs optimum, install it with: '
+                              'pip3 install "optimum[onnxruntime-gpu]" (or "optimum[onnxruntime]" for CPU only)')
+        from onnxruntime.capi.onnxruntime_pybind11_state import Fail, InvalidArgument, RuntimeException
+        self.model_errors = (RuntimeError, IndexError, Fail, InvalidArgument, RuntimeException)
+        provider = 'CUDAExecutionProvider' if self.cuda else 'CPUExecutionProvider'
+        return ORTModelForMaskedLM.from_pretrained(model_name, export=True, provider=provider)
 
     def tokenize_batch(self, batch):
         return [self.tokenizer.convert_tokens_to_ids(sent) for sent in batch]
@@ -55,173 +93,267 @@ class BertGeneration(object):
         print(" ".join(sent))
 
     def predict_masked(self, sent):
-        tokens = ['[CLS]'] + sent + ['[SEP]']
-        target_indices = [i for i, x in enumerate(tokens) if x == '[MASK]']
-        input_ids = self.tokenizer.convert_tokens_to_ids(tokens)
+        input_ids = [self.cls_id] + sent.tolist() + [self.sep_id]
         tens = torch.LongTensor(input_ids).unsqueeze(0)
         if self.cuda:
             tens = tens.cuda()
+        model = self.model if self.eager_model is None else self.eager_model
         try:
-            res = self.model(tens)[0]
-        except RuntimeError:  # Error in the model vocabulary, remove when a corret model is trained
+            with torch.inference_mode():
+                res = model(tens, attention_mask=torch.ones_like(tens))[0]
+        except self.model_errors:  # Error in the model vocabulary, remove when a corret model is trained
             return None
-        target_tensor = torch.LongTensor(target_indices)
-        if self.cuda:
-            target_tensor = target_tensor.cuda()
-        res = (torch.index_select(res, 1, target_tensor))
-        res = torch.narrow(torch.argsort(res, dim=-1, descending=True), -1, 0, 5)
-
-        predicted = []
-        for mask in res[0,]:
-            candidates = self.tokenizer.convert_ids_to_tokens([i.item() for i in mask])
-
-            predicted.append(candidates)
-
-        return predicted
-
+        res = res[tens == self.mask_id]  # (masks, vocab)
+        res = torch.topk(res, k=5, dim=-1).indices
 
-class DataMangler(object):
+        return res.cpu().numpy()  # (masks, 5) candidate ids, a single transfer back from the GPU
 
-    def __init__(self, file_name, min_len, max_len, max_sent):
-
-        self.sentences = self.read_sentences(file_name, min_len, max_len)
+    def predict_masked_batch(self, inputs):
+        """ Predicts the masked subword ids of a padded (2, batch, len) ids and attention mask tensor at once """
+        mask_counts = (inputs[0] == self.mask_id).sum(dim=1).tolist()
+        device_inputs = inputs
+        if self.cuda:
+            if self.device_buffer is None or self.device_buffer.numel() < inputs.numel():
+                self.device_buffer = torch.empty(inputs.numel(), dtype=torch.long, device='cuda')
+            device_inputs = self.device_buffer[:inputs.numel()].view(inputs.shape)
+            # inputs come in pinned memory, the copy is queued on the compute stream ahead of the forward pass
+            device_inputs.copy_(inputs, non_blocking=True)
+        input_ids, attention_mask = device_inputs[0], device_inputs[1]
+        try:
+            with torch.inference_mode():
+                res = self.model(input_ids, attention_mask=attention_mask)[0]
+        except torch._dynamo.exc.TorchDynamoException:  # compile failures are RuntimeErrors too, do not hide them
+            raise
+        except self.model_errors:  # one bad sentence spoils the whole batch, fall back to predicting one by one
+            lengths = inputs[1].sum(dim=1).tolist()
+            return [self.predict_masked(inputs[0, row, 1:length - 1].numpy()) for row, length in enumerate(lengths)
+                    if length > 0]
+
+        # logits of all masked positions in the batch, row by row, then split back per sentence
+        top_ids = torch.topk(res[input_ids == self.mask_id], k=5, dim=-1).indices.cpu().numpy()
+        return np.split(top_ids, np.cumsum(mask_counts)[:-1])
+
+
+class DataMangler(torch.utils.data.Dataset):
+
+    def __init__(self, file_names, min_len, max_len, max_sent, tokenizer, seed=None):
+
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.tokenizer = tokenizer
+        self.mask_id = tokenizer.mask_token_id
+        self.cls_id = tokenizer.cls_token_id
+        self.sep_id = tokenizer.sep_token_id
+        self.pad_id = tokenizer.pad_token_id
         self.max_eval_sentences = max_sent
+        self.sentences = self.read_sentences(file_names, min_len, max_len)
 
-    def read_sentences(self, file_name, min_len, max_len):
+    def read_file(self, file_name, min_len, max_len):
+        # keep every sentence in file order, or a uniform random sample of max_eval_sentences (reservoir sampling)
         sentences = []
+        seen = 0
         with open(file_name, "rt", encoding="utf-8") as f:
             for line in f:
                 if len(line.split(" ")) < min_len or len(line.split(" ")) > max_len:
                     continue
-                sentences.append(line.strip())
-        random.shuffle(sentences)
+                if self.max_eval_sentences == 0 or seen < self.max_eval_sentences:
+                    sentences.append(line.strip())
+                else:
+                    replace = self.rng.integers(seen + 1)
+                    if replace < self.max_eval_sentences:
+                        sentences[replace] = line.strip()
+                seen += 1
         return sentences
 
-    def glue_tokenized(self, tokenized):
-        tokenized_words = []
-        for subword in tokenized:
-            if not subword.startswith("##"):  # new word starts
-                tokenized_words.append([])
-            tokenized_words[-1].append(subword)
-        return tokenized_words
-
-    def random_mask(self, sent, p=0.15):
-        if len(sent) > 512 - 2:  # bert max seq len
+    def read_sentences(self, file_names, min_len, max_len):
+        sentences = []
+        file_indices = []
+        for file_idx, file_name in enumerate(file_names):
+            print(f"Loading {file_name} for masked language prediction...")
+            file_sentences = self.read_file(file_name, min_len, max_len)
+            sentences.extend(file_sentences)
+            file_indices.extend([file_idx] * len(file_sentences))
+        if not sentences:
+            return []
+        # tokenize once into subword ids and the word each subword belongs to, and sort the sentences of all files
+        # by subword length so that batches need as little padding as possible
+        encodings = self.tokenizer(sentences, add_special_tokens=False)
+        tokenized = []
+        for i, (file_idx, sentence) in enumerate(zip(file_indices, sentences)):
+            if self.mask_id in encodings["input_ids"][i]:  # a literal [MASK] in the text would be predicted too
+                continue
+            word_ids = np.array(encodings.word_ids(i), dtype=np.int64)
+            word_starts = np.flatnonzero(np.diff(word_ids, prepend=-1))  # first subword of every word
+            tokenized.append((file_idx, sentence, np.array(encodings["input_ids"][i], dtype=np.int64), word_ids,
+                              word_starts))
+        tokenized.sort(key=lambda x: len(x[2]))
+        return tokenized
+
+    def __len__(self):
+        return len(self.sentences)
+
+    def __getitem__(self, index):
+        """ Masks a random 15% of the words of a sentence, runs in the DataLoader workers """
+        file_idx, sentence, ids, word_ids, word_starts = self.sentences[index]
+        word_mask = self.random_mask(word_ids)
+        if word_mask is None:  # sentence is too short
             return None
-        num_tokens = int(round(len(sent) * p))
+        mask_positions = word_mask[word_ids]  # subwords of the masked words
+        return file_idx, sentence, ids, word_starts, mask_positions, self.mask_sent(ids, mask_positions)
+
+    @staticmethod
+    def seed_worker(worker_id):
+        """ Gives every DataLoader worker its own random stream, forked workers would otherwise share one """
+        worker_info = torch.utils.data.get_worker_info()
+        dataset = worker_info.dataset
+        dataset.rng = np.random.default_rng(worker_info.seed if dataset.seed is None else [dataset.seed, worker_id])
+
+    def random_mask(self, word_ids, p=0.15):
+        if len(word_ids) > 512 - 2:  # bert max seq len
+            return None
+        num_words = word_ids[-1] + 1 if len(word_ids) else 0
+        num_tokens = int(round(num_words * p))
         if num_tokens == 0:
             return None
-        indices = random.sample(range(len(sent)), num_tokens)
-        return indices
-
-    def mask_sent(self, sent, mask_indices):
-        masked_sentence = []
-        for i, token in enumerate(sent):
-            for subword in token:
-                if i in mask_indices:
-                    masked_sentence.append("[MASK]")
-                else:
-                    masked_sentence.append(subword)
-        return masked_sentence
-
-    def unmask_sent(self, sent, mask_indices, predicted, mark=True):
+        word_mask = np.zeros(num_words, dtype=bool)
+        word_mask[self.rng.choice(num_words, num_tokens, replace=False)] = True
+        return word_mask
+
+    def mask_sent(self, ids, mask_positions):
+        masked_ids = ids.copy()
+        masked_ids[mask_positions] = self.mask_id
+        return masked_ids
+
+    def unmask_sent(self, ids, word_starts, mask_positions, predicted, mark=True):
+        unmasked_ids = ids.copy()
+        unmasked_ids[mask_positions] = predicted[:, 0]
+        words = self.tokenizer.batch_decode([word.tolist() for word in np.split(unmasked_ids, word_starts[1:])])
         unmasked_sentence = []
-        for i, token in enumerate(sent):
-            for j, subword in enumerate(token):
-                if i in mask_indices:
-                    p_ = predicted.pop(0)[0]
-                    if j == 0:
-                        p_ = "**" + p_
-                    if j == len(token) - 1:
-                        p_ += "**"
-                    unmasked_sentence.append(p_)
-                else:
-                    unmasked_sentence.append(subword)
-        return self.my_detokenizer(unmasked_sentence)
-
-    def my_detokenizer(self, sent):
-        new_sent = []
-        for i, tok in enumerate(sent):
-            if tok.startswith("##"):
-                new_sent[len(new_sent) - 1] = new_sent[len(new_sent) - 1] + tok[2:]
-            elif tok.startswith("**##"):
-                new_sent[len(new_sent) - 1] = new_sent[len(new_sent) - 1] + "**" + tok[4:]
+        for word, masked in zip(words, mask_positions[word_starts].tolist()):
+            # a masked word predicted as a continuation piece (##) is glued to the previous word
+            glue = masked and word.startswith("##") and unmasked_sentence
+            if glue:
+                word = word[2:]
+            if masked and mark:
+                word = "**" + word + "**"
+            if glue:
+                unmasked_sentence[-1] += word
             else:
-                new_sent.append(tok)
-
-        return " ".join(new_sent).replace("****", "").replace("** **", " ")
-
-    def compare_subwords(self, glued_tokenized, predicted, mask_index):
-        correct = 0
-        for i, word in enumerate(glued_tokenized):
-            if i in mask_index:
-                for j, subword in enumerate(word):
-                    pred = predicted.pop(0)[0]
-                    if subword == pred:
-                        correct += 1
-        return correct
-
-    def predict_iterator(self, bert_model):
-
-        counter = 0
-
-        for sentence in self.sentences:
-
-            tokenized_sentence = bert_model.tokenizer.tokenize(sentence)
-
-            glued = self.glue_tokenized(tokenized_sentence)
-
-            mask_index = self.random_mask(glued)
-            if mask_index == None:  # sentence is too short
+                unmasked_sentence.append(word)
+        return " ".join(unmasked_sentence).replace("****", "").replace("** **", " ")
+
+    def compare_subwords(self, ids, predicted, mask_positions):
+        return int(np.sum(predicted[:, 0] == ids[mask_positions]))
+
+    def length_buckets(self, batch_size, bucket_width=4):
+        """ Groups the length sorted sentences into batches of indices that never span more than one length bucket """
+        batches = []
+        bucket = None
+        for index, (_, _, ids, _, _) in enumerate(self.sentences):
+            if not batches or len(batches[-1]) == batch_size or len(ids) // bucket_width != bucket:
+                batches.append([])
+            bucket = len(ids) // bucket_width
+            batches[-1].append(index)
+        return batches
+
+    def pad_collate(self, batch, batch_size=None, pad_to_multiple_of=None):
+        """ Pads the masked sentences of a batch into a (2, batch, len) input ids and attention mask tensor
+
+        With batch_size and pad_to_multiple_of set, empty rows are added up to batch_size and the length is rounded
+        up, which keeps the number of distinct input shapes small for a compiled model.
+        """
+        batch = [item for item in batch if item is not None]
+        if not batch:
+            return batch, None
+        max_len = max(len(masked_ids) for *_, masked_ids in batch) + 2
+        if pad_to_multiple_of:
+            max_len = -(-max_len // pad_to_multiple_of) * pad_to_multiple_of
+        inputs = torch.zeros((2, max(len(batch), batch_size or 0), max_len), dtype=torch.long)
+        inputs[0].fill_(self.pad_id)
+        for row, (*_, masked_ids) in enumerate(batch):
+            inputs[0, row, 0] = self.cls_id
+            inputs[0, row, 1:len(masked_ids) + 1] = torch.from_numpy(masked_ids)
+            inputs[0, row, len(masked_ids) + 1] = self.sep_id
+            inputs[1, row, :len(masked_ids) + 2] = 1
+        return batch, inputs
+
+    def predict_iterator(self, bert_model, batch_size=32, num_workers=4, static_shapes=False, verbose=False):
+
+        collate_fn = self.pad_collate
+        if static_shapes:
+            collate_fn = functools.partial(self.pad_collate, batch_size=batch_size, pad_to_multiple_of=8)
+        # masking and padding run in background workers while the model is busy with the previous batches
+        loader = torch.utils.data.DataLoader(self, batch_sampler=self.length_buckets(batch_size),
+                                             collate_fn=collate_fn, num_workers=num_workers,
+                                             worker_init_fn=self.seed_worker,
+                                             pin_memory=bert_model.cuda,
+                                             prefetch_factor=2 if num_workers > 0 else None)
+        for batch, inputs in loader:
+            if not batch:
                 continue
-            masked_sentence = self.mask_sent(glued, mask_index)
 
             # run bert
-            predicted = bert_model.predict_masked(masked_sentence)
-            if not predicted:
-                continue
+            batch_predicted = bert_model.predict_masked_batch(inputs)
 
-            correct_subwords = self.compare_subwords(glued, copy.copy(predicted),
-                                                     mask_index)  # number of correctly predicted subwords
-            total_subwords = sum([len(glued[mi]) for mi in mask_index])  # number of subwords
+            for item, predicted in zip(batch, batch_predicted):
+                file_idx, sentence, ids, word_starts, mask_positions, masked_ids = item
+                if predicted is None:
+                    continue
 
-            yield correct_subwords, total_subwords, (
-                " ".join(masked_sentence), sentence, self.unmask_sent(glued, mask_index, predicted, mark=True))
-            counter += 1
+                correct_subwords = self.compare_subwords(ids, predicted,
+                                                         mask_positions)  # number of correctly predicted subwords
+                total_subwords = int(mask_positions.sum())  # number of subwords
 
-            if self.max_eval_sentences != 0 and counter > self.max_eval_sentences:
-                break
+                # strings are only needed for printing the predictions
+                prediction = None
+                if verbose:
+                    masked_sentence = self.tokenizer.convert_ids_to_tokens(masked_ids.tolist())
+                    prediction = (" ".join(masked_sentence), sentence,
+                                  self.unmask_sent(ids, word_starts, mask_positions, predicted))
+                yield correct_subwords, total_subwords, file_idx, prediction
 
 
 def main(args):
-    correct_subwords = 0
-    total_subwords = 0
+    torch.set_grad_enabled(False)  # evaluation only, never build the autograd graph
+    correct_subwords = collections.defaultdict(int)
+    total_subwords = collections.defaultdict(int)
     total_accuracy = 0
 
     print(f"Loading language model from {args.model}")
-    bert_model = BertGeneration(args.model, args.tokenizer)
+    bert_model = BertGeneration(args.model, args.tokenizer, args.full_precision, args.compile, args.onnx,
+                                args.int8)
 
     target_files = os.path.join(args.input_dir, "*.txt")
-    input_files = glob.glob(target_files)
+    input_files = sorted(glob.glob(target_files))
     print(f"In {args.input_dir} there are {len(input_files)} input files for masked prediction")
 
-    for input_file in sorted(input_files):
-        print(f"Loading {input_file} for masked language prediction...")
-        dataset = DataMangler(input_file, args.min_len, args.max_len, args.max_sentences)
-        for correct_, total_, prediction_ in dataset.predict_iterator(bert_model):
-
-            correct_subwords += correct_
-            total_subwords += total_
-
-            if args.verbose:
-                print("Input:", prediction_[0], file=sys.stdout)
-                print("Orig:", prediction_[1], file=sys.stdout)
-                print("Pred:", prediction_[2], file=sys.stdout)
-                print(file=sys.stdout)
-        accuracy = correct_subwords / total_subwords
-        print("Correct:", correct_subwords, "Total:", total_subwords, "Accuracy:", accuracy * 100)
+    # sentences of all files share the batches, the accuracy is still counted per file
+    dataset = DataMangler(input_files, args.min_len, args.max_len, args.max_sentences, bert_model.tokenizer,
+                          args.seed)
+    predictions = dataset.predict_iterator(bert_model, args.batch_size, args.num_workers, args.compile,
+                                           args.verbose)
+    for correct_, total_, file_idx, prediction_ in predictions:
+
+        correct_subwords[file_idx] += correct_
+        total_subwords[file_idx] += total_
+
+        if args.verbose:
+            print("Input:", prediction_[0], file=sys.stdout)
+            print("Orig:", prediction_[1], file=sys.stdout)
+            print("Pred:", prediction_[2], file=sys.stdout)
+            print(file=sys.stdout)
+
+    evaluated_files = 0
+    for file_idx, input_file in enumerate(input_files):
+        if total_subwords[file_idx] == 0:  # no sentence of the file passed the length limits
+            print(input_file, "Correct: 0 Total: 0 Accuracy: N/A")
+            continue
+        accuracy = correct_subwords[file_idx] / total_subwords[file_idx]
+        print(input_file, "Correct:", correct_subwords[file_idx], "Total:", total_subwords[file_idx],
+              "Accuracy:", accuracy * 100)
         total_accuracy += accuracy
-    print("Final accuracy:", total_accuracy / len(input_files))
+        evaluated_files += 1
+    print("Final accuracy:", total_accuracy / evaluated_files if evaluated_files else "N/A")
 
 
 if __name__ == "__main__":
@@ -240,6 +372,20 @@ if __name__ == "__main__":
                            help='Maximum sentence length used in evaluation')
     argparser.add_argument('--max_sentences', default=0, type=int,
                            help='How many sentences to use in evaluation (Default: 0, use all))')
+    argparser.add_argument('--seed', type=int,
+                           help='Random seed for sampling sentences and masked words (Default: unseeded)')
+    argparser.add_argument('--batch_size', default=32, type=int,
+                           help='How many sentences to predict with a single forward pass')
+    argparser.add_argument('--num_workers', default=min(4, os.cpu_count() or 1), type=int,
+                           help='How many worker processes prepare the batches (0: use the main process)')
+    argparser.add_argument('--full_precision', default=False, action="store_true",
+                           help='Run the model in fp32 instead of bf16/fp16 on GPU.')
+    argparser.add_argument('--int8', default=False, action="store_true",
+                           help='Quantize the linear layers to int8 on CPU, results then depend on --batch_size.')
+    argparser.add_argument('--compile', default=False, action="store_true",
+                           help='Compile the model with torch.compile and pad the batches to static shapes.')
+    argparser.add_argument('--onnx', default=False, action="store_true",
+                           help='Export the model to ONNX and run it with ONNX Runtime (needs optimum).')
     argparser.add_argument('--verbose', default=False, action="store_true",
                            help='Print the original and predicted sentences.')
     args = argparser.parse_args()
@@ -70,12 +70,12 @@ class BertGeneration(object):
 
     def get_init_text(self, seed_text, max_len, batch_size=1, rand_init=False):
         """ Get initial sentence by padding seed_text with either masks or random words to max_len """
-        batch = [seed_text + [self.MASK] * max_len + [self.SEP] for _ in range(batch_size)]
+        init_ids = self.tokenizer.convert_tokens_to_ids(seed_text) + [self.mask_id] * max_len + [self.sep_id]
         # if rand_init:
         #    for ii in range(max_len):
         #        init_idx[seed_len+ii] = np.random.randint(0, len(tokenizer.vocab))
 
-        return self.tokenize_batch(batch)
+        return [list(init_ids) for _ in range(batch_size)]
 
     def printer(self, sent, should_detokenize=True):
         if should_detokenize: